@@ -7,7 +7,7 @@ from app.core.config import settings
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
 @router.post("/register", response_model=Token)
-async def register(user: UserCreate):
+def register(user: UserCreate):
     """Register a new user"""
     try:
         create_user(user.email, user.password)
@@ -22,7 +22,7 @@ async def register(user: UserCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/login", response_model=Token)
-async def login(user: UserLogin):
+def login(user: UserLogin):
     """Login and get access token"""
     user_obj = authenticate_user(user.email, user.password)
     if not user_obj:
@@ -4,44 +4,69 @@ from app.models.document import DocumentUploadResponse, QueryRequest, QueryRespo
 from app.models.conversation import ConversationRequest, ConversationResponse
 from app.models.user import User
 from app.services.auth import get_current_user
-from app.services.rag import rag_service
-from app.utils.pdf import extract_text_from_pdf
-from app.database import get_db
+from app.services.rag import RAGService, get_rag_service
+from app.utils.pdf import buffer_pdf_upload, iter_pdf_pages
+from app.database import flush_writes, get_db
+from typing import Dict, Iterator
 import uuid
 import json
 
 router = APIRouter(prefix="/rag", tags=["RAG"])
 
 
+def _event_stream(events: Iterator[Dict]) -> StreamingResponse:
+    """Send answer events as server-sent events"""
+    # Pull the first event here so retrieval failures still surface as HTTP errors
+    first = next(events)
+
+    def body():
+        yield f"data: {json.dumps(first)}\n\n"
+        try:
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'detail': str(e)})}\n\n"
+            return
+        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+
+    return StreamingResponse(body(), media_type="text/event-stream")
+
+
 @router.post("/upload", response_model=DocumentUploadResponse)
-async def upload_document(
+def upload_document(
         file: UploadFile = File(...),
-        current_user: User = Depends(get_current_user)
+        current_user: User = Depends(get_current_user),
+        rag_service: RAGService = Depends(get_rag_service)
 ):
     """Upload a PDF document"""
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
 
     try:
-        text = extract_text_from_pdf(file.file)
+        # Pages are chunked and sent for embedding while later pages are still being parsed
+        pages = iter_pdf_pages(buffer_pdf_upload(file.file))
+        result = rag_service.add_document_pages(pages, file.filename, current_user.email)
 
-        if not text.strip():
+        if result is None:
             raise HTTPException(status_code=400, detail="PDF contains no extractable text")
 
-        result = rag_service.add_document(text, file.filename, current_user.email)
-
         return DocumentUploadResponse(
             document_id=result["document_id"],
             filename=result["filename"],
             chunks_created=result["chunks_created"],
             message="Document uploaded successfully"
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
 
 
 @router.get("/documents")
-async def list_documents(current_user: User = Depends(get_current_user)):
+def list_documents(
+        current_user: User = Depends(get_current_user),
+        rag_service: RAGService = Depends(get_rag_service)
+):
     """List all user documents"""
     try:
         docs = rag_service.get_user_documents(current_user.email)
@@ -51,7 +76,11 @@ async def list_documents(current_user: User = Depends(get_current_user)):
 
 
 @router.delete("/documents/{doc_id}")
-async def delete_document(doc_id: str, current_user: User = Depends(get_current_user)):
+def delete_document(
+        doc_id: str,
+        current_user: User = Depends(get_current_user),
+        rag_service: RAGService = Depends(get_rag_service)
+):
     """Delete a document"""
     try:
         success = rag_service.delete_document(doc_id, current_user.email)
@@ -65,12 +94,16 @@ async def delete_document(doc_id: str, current_user: User = Depends(get_current_
 
 
 @router.post("/query", response_model=QueryResponse)
-async def query_documents(
+def query_documents(
         query: QueryRequest,
-        current_user: User = Depends(get_current_user)
+        current_user: User = Depends(get_current_user),
+        rag_service: RAGService = Depends(get_rag_service)
 ):
     """Query without conversation history"""
     try:
+        if query.stream:
+            return _event_stream(rag_service.query_stream(query.question, query.top_k))
+
         result = rag_service.query(query.question, query.top_k)
         return QueryResponse(
             answer=result["answer"],
@@ -81,30 +114,36 @@ async def query_documents(
 
 
 @router.post("/chat", response_model=ConversationResponse)
-async def chat_with_documents(
+def chat_with_documents(
         request: ConversationRequest,
-        current_user: User = Depends(get_current_user)
+        current_user: User = Depends(get_current_user),
+        rag_service: RAGService = Depends(get_rag_service)
 ):
     """Chat with conversation memory"""
     try:
         # Create or get conversation
         conversation_id = request.conversation_id
-        if not conversation_id:
+        # A new conversation is created in the same transaction that saves its first turn
+        new_conversation = not conversation_id
+        if new_conversation:
             conversation_id = str(uuid.uuid4())
-            # Create conversation in DB
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO conversations (id, user_email) VALUES (?, ?)",
-                    (conversation_id, current_user.email)
-                )
-                conn.commit()
+
+        if request.stream:
+            # Sources (with the conversation id) go first, then answer tokens
+            return _event_stream(rag_service.query_with_conversation_stream(
+                request.question,
+                conversation_id,
+                current_user.email,
+                request.top_k,
+                new_conversation
+            ))
 
         result = rag_service.query_with_conversation(
             request.question,
             conversation_id,
             current_user.email,
-            request.top_k
+            request.top_k,
+            new_conversation
         )
 
         return ConversationResponse(
@@ -117,18 +156,27 @@ async def chat_with_documents(
 
 
 @router.get("/conversations")
-async def list_conversations(current_user: User = Depends(get_current_user)):
+def list_conversations(current_user: User = Depends(get_current_user)):
     """List all user conversations"""
     try:
+        # Include chat turns still queued for the background writer
+        flush_writes()
         with get_db() as conn:
             cursor = conn.cursor()
+            # One pass over the user's messages instead of a subquery per conversation
             cursor.execute(
-                """SELECT c.id, c.created_at, 
-                   (SELECT content FROM messages WHERE conversation_id = c.id AND role = 'user' ORDER BY created_at ASC LIMIT 1) as first_message
-                   FROM conversations c 
-                   WHERE c.user_email = ? 
+                """SELECT c.id, c.created_at, m.content AS first_message
+                   FROM conversations c
+                   LEFT JOIN (
+                       SELECT conversation_id, content,
+                              ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY created_at, id) AS rn
+                       FROM messages
+                       WHERE role = 'user'
+                         AND conversation_id IN (SELECT id FROM conversations WHERE user_email = ?)
+                   ) m ON m.conversation_id = c.id AND m.rn = 1
+                   WHERE c.user_email = ?
                    ORDER BY c.created_at DESC""",
-                (current_user.email,)
+                (current_user.email, current_user.email)
             )
             rows = cursor.fetchall()
             conversations = [
@@ -145,12 +193,13 @@ async def list_conversations(current_user: User = Depends(get_current_user)):
 
 
 @router.get("/conversations/{conversation_id}/messages")
-async def get_conversation_messages(
+def get_conversation_messages(
         conversation_id: str,
         current_user: User = Depends(get_current_user)
 ):
     """Get all messages in a conversation"""
     try:
+        flush_writes()
         with get_db() as conn:
             cursor = conn.cursor()
             # Verify ownership
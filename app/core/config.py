@@ -8,6 +8,54 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Vector index type: "hnsw", "hnsw_sq8" (HNSW over 8-bit scalar-quantized vectors,
+    # 4x smaller) or "ivfpq" (IVF-PQ fast-scan, for large corpora)
+    FAISS_INDEX_TYPE: str = "hnsw"
+
+    # FAISS HNSW graph parameters (higher ef = better recall, slower search)
+    FAISS_HNSW_M: int = 32
+    FAISS_HNSW_EF_CONSTRUCTION: int = 200
+    FAISS_HNSW_EF_SEARCH: int = 64
+
+    # Vectors collected before the scalar quantizer of "hnsw_sq8" is trained
+    FAISS_SQ_TRAIN_SIZE: int = 1000
+
+    # FAISS IVF-PQ fast-scan parameters (4-bit PQ codes, trained once enough vectors exist).
+    # FAISS_PQ_M must divide the dimension; 64 gives 16 dimensions per sub-quantizer for 1024-d
+    # vectors. Training wants roughly 39 vectors per list, and at least FAISS_IVF_NLIST.
+    FAISS_IVF_NLIST: int = 256
+    FAISS_IVF_NPROBE: int = 16
+    FAISS_PQ_M: int = 64
+    FAISS_IVF_TRAIN_SIZE: int = 10000
+
+    # New vectors are buffered in an in-memory delta index and merged into the
+    # memory-mapped base index in the background once this many accumulate
+    FAISS_DELTA_MERGE_SIZE: int = 5000
+
+    # FAISS search threading: concurrent queries are batched within this window
+    FAISS_OMP_THREADS: int = 1
+    FAISS_SEARCH_BATCH_WINDOW_MS: float = 2.0
+
+    # Number of query embeddings kept in memory to skip repeat Cohere calls
+    QUERY_EMBED_CACHE_SIZE: int = 10000
+    # Concurrent Cohere requests when embedding a large document
+    EMBED_CONCURRENCY: int = 4
+    # Retries of a failed Cohere request; the backoff cap doubles from the base delay each attempt
+    EMBED_MAX_RETRIES: int = 4
+    EMBED_RETRY_BASE_DELAY: float = 0.5
+
+    # Answer cache; paraphrased questions hit when cosine similarity >= threshold
+    ANSWER_CACHE_SIZE: int = 2048
+    ANSWER_CACHE_TTL: int = 3600
+    ANSWER_CACHE_SIMILARITY: float = 0.97
+
+    # Conversations whose recent messages are kept in memory for the next chat turn
+    CONVERSATION_CACHE_SIZE: int = 1000
+
+    # Prompt token budget for the LLM call, including the answer; the oldest history and then
+    # the tail of each retrieved chunk are dropped to fit. Kept well below the model window.
+    LLM_CONTEXT_TOKENS: int = 8192
+
     class Config:
         env_file = ".env"
         extra = "allow"  # This allows extra fields
@@ -1,12 +1,43 @@
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "./rag_app.db"
 
+# How long the background writer collects queued writes before committing them together
+WRITE_BATCH_INTERVAL = 0.05
+
+# Per-connection tuning. Under WAL, synchronous=NORMAL only fsyncs at checkpoints
+# instead of on every commit, and readers no longer block the writer.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 
 def init_db():
     """Initialize database tables"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
+    # journal_mode is persistent, so setting it once here applies to every later connection
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
 
     # Users table
@@ -53,20 +84,205 @@ def init_db():
         )
     """)
 
+    # Chunk text and metadata, keyed by the chunk's vector id in the FAISS index
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chunks (
+            vec_id INTEGER PRIMARY KEY,
+            doc_id TEXT NOT NULL,
+            user_email TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            chunk_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            FOREIGN KEY (doc_id) REFERENCES documents(doc_id)
+        )
+    """)
+
+    # Document embeddings by model and SHA-256 of the chunk text, as float32 bytes
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            model TEXT NOT NULL,
+            hash BLOB NOT NULL,
+            vec BLOB NOT NULL,
+            PRIMARY KEY (model, hash)
+        ) WITHOUT ROWID
+    """)
+
+    # Indexes for per-conversation message lookups and per-user listings
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_time ON messages(conversation_id, created_at)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_conv_role_time ON messages(conversation_id, role, created_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_time ON conversations(user_email, created_at DESC)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_user ON documents(user_email)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id, user_email)")
+
     conn.commit()
+    # Refresh planner statistics so the new indexes get picked up
+    conn.execute("ANALYZE")
     conn.close()
 
 
-@contextmanager
-def get_db():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+class ConnectionPool:
+    """Long-lived SQLite connections: one writer plus a fixed set of readers.
+
+    Reusing connections keeps each one's page cache warm across requests.
+    SQLite allows a single writer at a time, so writes queue on one connection
+    and take the write lock up front with BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, readers: int):
+        self._writer = queue.Queue(maxsize=1)
+        self._writer.put(_connect())
+        self._readers = queue.Queue(maxsize=readers)
+        for _ in range(readers):
+            self._readers.put(_connect())
+
+    @contextmanager
+    def connection(self, write: bool = False):
+        pool = self._writer if write else self._readers
+        conn = pool.get()
+        try:
+            if write:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+        finally:
+            # Discard anything left uncommitted, including after an exception
+            if conn.in_transaction:
+                conn.rollback()
+            pool.put(conn)
+
+    def close(self):
+        for pool in (self._writer, self._readers):
+            while not pool.empty():
+                conn = pool.get_nowait()
+                conn.execute("PRAGMA optimize")
+                conn.close()
+
 
+# A queued write: statements run together, each with the parameter rows passed to executemany
+WriteJob = List[Tuple[str, Sequence[Sequence[Any]]]]
 
-# Initialize on import
-init_db()
\ No newline at end of file
+
+class BackgroundWriter:
+    """Single thread that commits queued writes in batches.
+
+    Requests enqueue writes they do not need to wait for; the writer gathers
+    whatever arrives within WRITE_BATCH_INTERVAL and commits it in one
+    transaction, so many request-path commits become one. Readers that must see
+    those writes call flush() first. A job that cannot be committed is logged and
+    its on_error callback, if any, runs on the writer thread.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, job: WriteJob, on_error: Optional[Callable[[], None]] = None):
+        self._jobs.put((job, on_error))
+
+    def flush(self):
+        """Block until every write submitted so far is committed"""
+        done = threading.Event()
+        self._jobs.put(done)
+        done.wait()
+
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            items = [self._jobs.get()]
+            deadline = time.monotonic() + WRITE_BATCH_INTERVAL
+            # A flush marker or stop ends the batch early, as someone is waiting on it
+            while isinstance(items[-1], tuple):
+                try:
+                    items.append(self._jobs.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            batch = [item for item in items if isinstance(item, tuple)]
+            if batch:
+                self._commit(batch)
+            # Jobs are committed in order, so everything queued before a flush marker is done
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if items[-1] is None:
+                return
+
+    def _commit(self, batch: List[Tuple[WriteJob, Optional[Callable[[], None]]]]):
+        try:
+            self._write([job for job, _ in batch])
+        except Exception:
+            # Retry one job per transaction so a bad job cannot drop the others
+            for job, on_error in batch:
+                try:
+                    self._write([job])
+                except Exception:
+                    logger.exception("Background database write failed")
+                    if on_error is not None:
+                        try:
+                            on_error()
+                        except Exception:
+                            logger.exception("Background write error callback failed")
+
+    def _write(self, batch: List[WriteJob]):
+        with get_db(write=True) as conn:
+            for job in batch:
+                for sql, rows in job:
+                    conn.executemany(sql, rows)
+            conn.commit()
+
+
+_pool: Optional[ConnectionPool] = None
+_writer: Optional[BackgroundWriter] = None
+_pool_lock = threading.Lock()
+
+
+def init_pool():
+    """Open the shared connection pool and background writer (called from the app lifespan)"""
+    global _pool, _writer
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(readers=min(os.cpu_count() or 1, 8))
+            _writer = BackgroundWriter()
+
+
+def close_pool():
+    global _pool, _writer
+    with _pool_lock:
+        if _pool is not None:
+            # Commit the queued writes while the writer connection is still open
+            _writer.stop()
+            _writer = None
+            _pool.close()
+            _pool = None
+
+
+def submit_write(job: WriteJob, on_error: Optional[Callable[[], None]] = None):
+    """Queue statements to be committed together in the background, without waiting for them.
+
+    on_error runs on the writer thread if the job cannot be committed.
+    """
+    if _writer is None:
+        init_pool()
+    _writer.submit(job, on_error)
+
+
+def flush_writes():
+    """Wait for queued background writes, so a following read sees them"""
+    if _writer is not None:
+        _writer.flush()
+
+
+@contextmanager
+def get_db(write: bool = False):
+    """Context manager for pooled database connections; pass write=True for inserts/updates/deletes"""
+    if _pool is None:
+        init_pool()
+    with _pool.connection(write) as conn:
+        yield conn
@@ -1,11 +1,28 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import auth, rag
+from app.database import init_db, init_pool, close_pool
+from app.services.rag import close_rag_service, get_rag_service
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup and index loading block, so keep them off the event loop
+    await asyncio.to_thread(init_db)
+    init_pool()
+    await asyncio.to_thread(get_rag_service)
+    yield
+    await asyncio.to_thread(close_rag_service)
+    close_pool()
+
 
 app = FastAPI(
     title="RAG Chatbot API",
     description="Production-ready RAG system with JWT authentication",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -9,6 +9,7 @@ class ConversationRequest(BaseModel):
     question: str
     conversation_id: Optional[str] = None
     top_k: Optional[int] = 3
+    stream: bool = False  # respond with server-sent events instead of JSON
 
 class ConversationResponse(BaseModel):
     answer: str
@@ -10,6 +10,7 @@ class DocumentUploadResponse(BaseModel):
 class QueryRequest(BaseModel):
     question: str
     top_k: Optional[int] = 3
+    stream: bool = False  # respond with server-sent events instead of JSON
 
 class QueryResponse(BaseModel):
     answer: str
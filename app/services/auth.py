@@ -1,6 +1,11 @@
+import hashlib
+import hmac
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+from cachetools import TTLCache
+from jose import JWTError, jwk, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -11,11 +16,39 @@ from app.database import get_db
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# Build the signing key once; passing the raw secret makes python-jose re-construct it on every call
+_jwt_key = jwk.construct(settings.SECRET_KEY, settings.ALGORITHM)
+
+# Recent successful logins, so repeat logins from the same client skip the ~100 ms bcrypt check.
+# Keyed by the stored hash too, so a password change invalidates the entry.
+_login_cache = TTLCache(maxsize=10000, ttl=30)
+_login_cache_lock = threading.Lock()
+
+# Users resolved from bearer tokens, so authenticated requests skip the users table lookup.
+# The TTL bounds how long a removed account keeps working with an unexpired token.
+_user_cache = TTLCache(maxsize=10000, ttl=300)
+_user_cache_lock = threading.Lock()
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def _verify_password_cached(email: str, plain_password: str, hashed_password: str) -> bool:
+    # Keep only a keyed digest of the password in memory, never the password itself
+    digest = hmac.new(settings.SECRET_KEY.encode(), plain_password.encode('utf-8'), hashlib.sha256).digest()
+    key = (email, hashed_password, digest)
+    with _login_cache_lock:
+        if key in _login_cache:
+            return True
+
+    if not verify_password(plain_password, hashed_password):
+        return False
+    with _login_cache_lock:
+        _login_cache[key] = True
+    return True
+
+
 def get_password_hash(password):
     if len(password.encode('utf-8')) > 72:
         password = password[:72]
@@ -29,28 +62,34 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _jwt_key, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
 
 def create_user(email: str, password: str) -> User:
+    # Check if user exists
     with get_db() as conn:
         cursor = conn.cursor()
-
-        # Check if user exists
         cursor.execute("SELECT email FROM users WHERE email = ?", (email,))
         if cursor.fetchone():
             raise HTTPException(status_code=400, detail="Email already registered")
 
-        # Create user
-        hashed_password = get_password_hash(password)
-        cursor.execute(
-            "INSERT INTO users (email, hashed_password) VALUES (?, ?)",
-            (email, hashed_password)
-        )
+    # Hash before taking the write lock, which bcrypt would otherwise hold for ~100 ms
+    hashed_password = get_password_hash(password)
+
+    # Create user
+    with get_db(write=True) as conn:
+        try:
+            conn.execute(
+                "INSERT INTO users (email, hashed_password) VALUES (?, ?)",
+                (email, hashed_password)
+            )
+        except sqlite3.IntegrityError:
+            # Registered concurrently since the check above
+            raise HTTPException(status_code=400, detail="Email already registered")
         conn.commit()
 
-        return User(email=email, hashed_password=hashed_password)
+    return User(email=email, hashed_password=hashed_password)
 
 
 def authenticate_user(email: str, password: str):
@@ -59,17 +98,18 @@ def authenticate_user(email: str, password: str):
         cursor.execute("SELECT email, hashed_password FROM users WHERE email = ?", (email,))
         row = cursor.fetchone()
 
-        if not row:
-            return False
+    if not row:
+        return False
 
-        user = User(email=row["email"], hashed_password=row["hashed_password"])
-        if not verify_password(password, user.hashed_password):
-            return False
+    # Verify after returning the connection to the pool; bcrypt would otherwise hold it ~100 ms
+    user = User(email=row["email"], hashed_password=row["hashed_password"])
+    if not _verify_password_cached(user.email, password, user.hashed_password):
+        return False
 
-        return user
+    return user
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -77,7 +117,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     )
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = jwt.decode(token, _jwt_key, algorithms=[settings.ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -85,6 +125,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise credentials_exception
 
+    with _user_cache_lock:
+        user = _user_cache.get(token_data.email)
+    if user is not None:
+        return user
+
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT email, hashed_password FROM users WHERE email = ?", (token_data.email,))
@@ -93,4 +138,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not row:
             raise credentials_exception
 
-        return User(email=row["email"], hashed_password=row["hashed_password"])
\ No newline at end of file
+        user = User(email=row["email"], hashed_password=row["hashed_password"])
+    with _user_cache_lock:
+        _user_cache[token_data.email] = user
+    return user
\ No newline at end of file
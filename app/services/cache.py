@@ -0,0 +1,88 @@
+import hashlib
+import threading
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from cachetools import TTLCache
+
+from app.core.config import settings as app_settings
+
+# Neighbours checked per semantic lookup, so a few expired entries do not hide a live match
+SEMANTIC_CANDIDATES = 4
+
+
+class AnswerCache:
+    """Exact and semantic cache of RAG answers.
+
+    Entries are keyed by SHA-256 of the question within a scope (anything else
+    the answer depends on, e.g. top_k, corpus version and conversation).
+    Paraphrases are caught by an exact inner-product search over the
+    normalized embeddings of the questions cached in the same scope.
+    """
+
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+        self._answers = TTLCache(maxsize=app_settings.ANSWER_CACHE_SIZE, ttl=app_settings.ANSWER_CACHE_TTL)
+        self._similarity = app_settings.ANSWER_CACHE_SIMILARITY
+        # scope -> (question embeddings, answer key of each row)
+        self._questions: Dict[Hashable, Tuple[faiss.IndexFlatIP, List[tuple]]] = {}
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def _key(self, question: str, scope: Hashable) -> tuple:
+        return (hashlib.sha256(question.encode('utf-8')).digest(), scope)
+
+    def get(self, question: str, scope: Hashable) -> Optional[Dict]:
+        with self._lock:
+            return self._answers.get(self._key(question, scope))
+
+    def get_similar(self, embedding: np.ndarray, scope: Hashable) -> Optional[Dict]:
+        """Return the answer of a cached question whose embedding is close enough"""
+        with self._lock:
+            entry = self._questions.get(scope)
+            if entry is None:
+                return None
+            index, keys = entry
+            scores, rows = index.search(embedding.reshape(1, -1), min(SEMANTIC_CANDIDATES, index.ntotal))
+            for score, row in zip(scores[0], rows[0]):
+                if score < self._similarity:
+                    break
+                # Expired answers have already left the TTL cache
+                answer = self._answers.get(keys[row])
+                if answer is not None:
+                    return answer
+        return None
+
+    def put(self, question: str, scope: Hashable, embedding: np.ndarray, answer: Dict):
+        key = self._key(question, scope)
+        with self._lock:
+            self._answers[key] = answer
+            entry = self._questions.get(scope)
+            if entry is None:
+                entry = self._questions[scope] = (faiss.IndexFlatIP(self.dimension), [])
+            index, keys = entry
+            index.add(embedding.reshape(1, -1))
+            keys.append(key)
+            self._rows += 1
+            if self._rows > 2 * len(self._answers):
+                self._compact()
+
+    def _compact(self):
+        """Drop question embeddings whose answers were evicted or expired"""
+        self._rows = 0
+        for scope, (index, keys) in list(self._questions.items()):
+            live = [row for row, key in enumerate(keys) if key in self._answers]
+            if not live:
+                del self._questions[scope]
+            elif len(live) < len(keys):
+                compacted = faiss.IndexFlatIP(self.dimension)
+                compacted.add(index.reconstruct_batch(np.array(live, dtype=np.int64)))
+                self._questions[scope] = (compacted, [keys[row] for row in live])
+            self._rows += len(live)
+
+    def clear(self):
+        with self._lock:
+            self._answers.clear()
+            self._questions.clear()
+            self._rows = 0
@@ -0,0 +1,142 @@
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import cohere
+import faiss
+import httpx
+import numpy as np
+from cachetools import LRUCache
+from cohere.core.api_error import ApiError
+
+from app.core.config import settings as app_settings
+from app.database import get_db
+
+EMBED_MODEL = "embed-english-v3.0"
+# Maximum number of texts Cohere accepts per embed request
+EMBED_BATCH_SIZE = 96
+# Hashes per embedding cache lookup, well under SQLite's bound parameter limit
+CACHE_LOOKUP_BATCH = 500
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and dropped connections are worth retrying"""
+    if isinstance(error, ApiError):
+        return error.status_code is not None and (error.status_code == 429 or error.status_code >= 500)
+    return isinstance(error, httpx.TransportError)
+
+
+class Embedder:
+    """Cohere embedding client returning L2-normalized float32 vectors"""
+
+    def __init__(self, dimension: int, http_client: Optional[httpx.Client] = None):
+        self.client = cohere.Client(api_key=app_settings.COHERE_API_KEY, httpx_client=http_client)
+        self.model = EMBED_MODEL
+        self.dimension = dimension
+
+        # sha256(question) -> normalized query embedding; cachetools caches are not thread-safe
+        self._query_cache = LRUCache(maxsize=app_settings.QUERY_EMBED_CACHE_SIZE)
+        self._cache_lock = threading.Lock()
+
+        # Overlaps the network latency of multi-batch document embeds
+        self._executor = ThreadPoolExecutor(
+            max_workers=app_settings.EMBED_CONCURRENCY, thread_name_prefix="embed"
+        )
+
+    def close(self):
+        """Wait for in-flight embedding batches and stop the worker threads"""
+        self._executor.shutdown()
+
+    def embed(self, texts: List[str], input_type: str) -> np.ndarray:
+        response = self._embed_with_retry(texts, input_type)
+        # Convert straight to float32 rather than building a float64 array and copying it
+        embeddings = np.asarray(response.embeddings, dtype=np.float32)
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def _embed_with_retry(self, texts: List[str], input_type: str):
+        """Call the embed API, retrying transient failures with exponentially growing, jittered delays"""
+        for attempt in range(app_settings.EMBED_MAX_RETRIES + 1):
+            try:
+                return self.client.embed(
+                    texts=texts,
+                    model=self.model,
+                    input_type=input_type,
+                    # Over-long chunks lose their tail instead of failing the whole batch
+                    truncate="END"
+                )
+            except Exception as e:
+                if attempt == app_settings.EMBED_MAX_RETRIES or not _is_retryable(e):
+                    raise
+                # Full jitter keeps concurrent batches from retrying in lockstep after a 429
+                time.sleep(random.uniform(0, app_settings.EMBED_RETRY_BASE_DELAY * 2 ** attempt))
+
+    def _embed_uncached(self, texts: List[str]) -> np.ndarray:
+        """Embed document chunks in concurrent batches, preserving input order"""
+        if len(texts) <= EMBED_BATCH_SIZE:
+            return self.embed(texts, "search_document")
+
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        results = self._executor.map(lambda batch: self.embed(batch, "search_document"), batches)
+        return np.vstack(list(results))
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed document chunks, calling Cohere only for texts not embedded before"""
+        hashes = [hashlib.sha256(text.encode('utf-8')).digest() for text in texts]
+        cached = {}
+        with get_db() as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(hashes), CACHE_LOOKUP_BATCH):
+                batch = hashes[i:i + CACHE_LOOKUP_BATCH]
+                cursor.execute(
+                    f"SELECT hash, vec FROM embedding_cache WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [self.model, *batch]
+                )
+                cached.update((row["hash"], row["vec"]) for row in cursor.fetchall())
+
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        # Positions of each text still to embed; repeated chunks are embedded once
+        misses: Dict[bytes, List[int]] = {}
+        for i, digest in enumerate(hashes):
+            vec = cached.get(digest)
+            if vec is None:
+                misses.setdefault(digest, []).append(i)
+            else:
+                embeddings[i] = np.frombuffer(vec, dtype=np.float32)
+
+        if misses:
+            embedded = self._embed_uncached([texts[rows[0]] for rows in misses.values()])
+            for rows, vec in zip(misses.values(), embedded):
+                embeddings[rows] = vec
+            with get_db(write=True) as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO embedding_cache (model, hash, vec) VALUES (?, ?, ?)",
+                    [(self.model, digest, vec.tobytes()) for digest, vec in zip(misses, embedded)]
+                )
+                conn.commit()
+        return embeddings
+
+    def submit_documents(self, texts: List[str]) -> Future:
+        """Start embedding one batch of document chunks in the background"""
+        if len(texts) > EMBED_BATCH_SIZE:
+            # embed_documents would split the batch onto this same pool and wait on itself
+            raise ValueError(f"at most {EMBED_BATCH_SIZE} texts per submitted batch")
+        return self._executor.submit(self.embed_documents, texts)
+
+    def embed_with_cache(self, question: str) -> np.ndarray:
+        """Embed a search query, reusing the cached vector for a repeated question"""
+        key = hashlib.sha256(question.encode('utf-8')).digest()
+        with self._cache_lock:
+            embedding = self._query_cache.get(key)
+        if embedding is not None:
+            return embedding
+
+        embedding = self.embed([question], "search_query")
+        # Cached arrays are shared between callers, so guard against in-place edits
+        embedding.setflags(write=False)
+        with self._cache_lock:
+            self._query_cache[key] = embedding
+        return embedding
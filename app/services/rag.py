@@ -1,92 +1,321 @@
-import faiss
+import hashlib
+import json
 import numpy as np
 import pickle
 import os
-import cohere
+import threading
+from cachetools import LRUCache
+from collections import deque
+from concurrent.futures import Future
 from groq import Groq
-from typing import List, Dict
+import httpx
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
 import uuid
 from app.core.config import settings as app_settings
-from app.database import get_db
+from app.database import flush_writes, get_db, submit_write
+from app.services.cache import AnswerCache
+from app.services.embeddings import EMBED_BATCH_SIZE, Embedder
+from app.services.vector_store import VectorStore
+from app.utils.tokens import count_tokens, truncate_tokens
+
+# Idle connections to the Cohere and Groq APIs are kept open this long for reuse
+HTTP_KEEPALIVE_SECONDS = 300
+
+# Most recent messages of a conversation kept as chat history
+HISTORY_LIMIT = 10
+
+# Code points str.split() treats as whitespace; all of them are below U+3001
+WHITESPACE_TABLE = np.zeros(0x3002, dtype=bool)
+WHITESPACE_TABLE[[c for c in range(0x3001) if chr(c).isspace()]] = True
+
+LLM_MODEL = "llama-3.1-8b-instant"
+MAX_ANSWER_TOKENS = 500
+# Tokens each chat message adds on top of its content (role and delimiters)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Prompt text shared by every request. Keeping it byte-identical and ahead of the variable
+# context/question lets the provider reuse its cached prefix computation across calls.
+QUERY_SYSTEM_PROMPT = ("You are a helpful assistant that answers questions based on the provided context. "
+                       "Be concise and accurate.")
+CHAT_SYSTEM_PROMPT = ("You are a helpful assistant that answers questions based on the provided context "
+                      "and conversation history. Be concise and accurate.")
+QUERY_PROMPT_PREFIX = ("Based on the following context, answer the question. "
+                       "If you cannot answer based on the context, say so.\n\nContext:\n")
+CHAT_PROMPT_PREFIX = "Based on the following context, answer the question:\n\nContext:\n"
+
+
+def _fit_prompt(fixed: List[str], history: List[Dict], contexts: List[str]) -> Tuple[List[Dict], List[str]]:
+    """Fit a prompt into the token budget, dropping the oldest history first, then trimming the
+    tail of every context by the same proportion; the fixed parts are always sent whole"""
+    # The system and user messages, plus each context's label
+    overhead = (2 + len(contexts)) * MESSAGE_TOKEN_OVERHEAD
+    budget = app_settings.LLM_CONTEXT_TOKENS - MAX_ANSWER_TOKENS - overhead
+    budget -= sum(count_tokens(text) for text in fixed)
+    history_tokens = [count_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD for message in history]
+    context_tokens = [count_tokens(ctx) for ctx in contexts]
+    total = sum(history_tokens) + sum(context_tokens)
+
+    dropped = 0
+    while total > budget and dropped < len(history):
+        total -= history_tokens[dropped]
+        dropped += 1
+    history = history[dropped:]
+
+    # Nothing left to trim if the fixed parts alone fill the budget and no context was retrieved
+    if total > budget and total:
+        scale = max(budget, 0) / total
+        contexts = [truncate_tokens(ctx, int(tokens * scale)) for ctx, tokens in zip(contexts, context_tokens)]
+    return history, contexts
 
 
 class RAGService:
     def __init__(self):
         self.dimension = 1024
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.documents = []
-        self.metadatas = []
+        # Routes run in a threadpool; keeps the vector ids and the chunks table in step
+        self._index_lock = threading.Lock()
 
         self.index_path = "./faiss_index.bin"
+        # Chunk metadata pickle used before it moved to the chunks table; imported once on load
         self.meta_path = "./faiss_meta.pkl"
-        self._load_index()
-
-        self.cohere_client = cohere.Client(api_key=app_settings.COHERE_API_KEY)
-        self.groq_client = Groq(api_key=app_settings.GROQ_API_KEY)
-
-    def _load_index(self):
-        if os.path.exists(self.index_path) and os.path.exists(self.meta_path):
-            self.index = faiss.read_index(self.index_path)
-            with open(self.meta_path, 'rb') as f:
-                data = pickle.load(f)
-                self.documents = data['documents']
-                self.metadatas = data['metadatas']
-
-    def _save_index(self):
-        faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, 'wb') as f:
-            pickle.dump({
-                'documents': self.documents,
-                'metadatas': self.metadatas
-            }, f)
-
-    def chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            if chunk.strip():  # Only add non-empty chunks
-                chunks.append(chunk)
-        return chunks
-
-    def add_document(self, text: str, filename: str, user_email: str) -> Dict:
-        chunks = self.chunk_text(text)
-        doc_id = str(uuid.uuid4())
-
-        response = self.cohere_client.embed(
-            texts=chunks,
-            model="embed-english-v3.0",
-            input_type="search_document"
+        self.vectors = VectorStore(self.dimension, self.index_path)
+        # Loaded by warmup(), which get_rag_service() runs before handing the service out
+        self._loaded = False
+
+        # One keep-alive connection pool shared by the Cohere and Groq clients, so requests
+        # reuse warm TCP+TLS connections instead of handshaking again
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=HTTP_KEEPALIVE_SECONDS),
+            # Both SDKs pass their own per-request timeouts; this only bounds anything else
+            timeout=httpx.Timeout(60.0)
         )
-        embeddings = np.array(response.embeddings).astype('float32')
+        self.embedder = Embedder(self.dimension, self.http_client)
+
+        # Bumped on every corpus change so cached answers never outlive their sources
+        self._corpus_version = 0
+        self.answer_cache = AnswerCache(self.dimension)
+        # conversation_id -> deque of its last HISTORY_LIMIT messages, so warm turns skip the SELECT
+        self._histories = LRUCache(maxsize=app_settings.CONVERSATION_CACHE_SIZE)
+        self._histories_lock = threading.Lock()
+        # Turns saved while their conversation was not cached; a reload that overlaps one is not cached
+        self._history_misses = 0
+        # Identical concurrent requests wait on the first one's result instead of repeating its API calls
+        self._inflight: Dict[Hashable, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.groq_client = Groq(api_key=app_settings.GROQ_API_KEY, http_client=self.http_client)
+
+    def _invalidate_answers(self):
+        self._corpus_version += 1
+        self.answer_cache.clear()
+
+    def _search(self, query_embedding: np.ndarray, top_k: int):
+        """Return (contexts, metadatas) for the top_k nearest chunks"""
+        # Search outside the lock so concurrent queries can be batched by the vector store
+        scores, indices = self.vectors.search(query_embedding, top_k)
+
+        ids = [int(idx) for idx in indices]
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT vec_id, doc_id, user_email, filename, chunk_id, content FROM chunks "
+                f"WHERE vec_id IN ({','.join('?' * len(ids))})",
+                ids
+            )
+            rows = {row["vec_id"]: row for row in cursor.fetchall()}
 
-        self.index.add(embeddings)
+        contexts = []
+        metadatas = []
+        for idx, score in zip(ids, scores):
+            row = rows.get(idx)
+            # Rows of a document still being added are not committed yet, and a
+            # concurrent delete may have removed some since the search
+            if row is not None:
+                contexts.append(row["content"])
+                metadatas.append({
+                    "filename": row["filename"],
+                    "doc_id": row["doc_id"],
+                    "chunk_id": row["chunk_id"],
+                    "user_email": row["user_email"],
+                    # Cosine similarity; higher is closer
+                    "score": float(score)
+                })
+        return contexts, metadatas
+
+    def _format_sources(self, contexts: List[str], metadatas: List[Dict]) -> List[Dict]:
+        return [
+            {
+                "filename": meta["filename"],
+                "chunk_id": meta["chunk_id"],
+                "score": round(meta["score"], 4),
+                "text": ctx[:200] + "..."
+            }
+            for meta, ctx in zip(metadatas, contexts)
+        ]
 
-        for i, chunk in enumerate(chunks):
-            self.documents.append(chunk)
-            self.metadatas.append({
-                "filename": filename,
-                "doc_id": doc_id,
-                "chunk_id": i,
-                "user_email": user_email
-            })
+    def warmup(self):
+        """Load the vector index and import any legacy metadata; safe to call more than once"""
+        with self._index_lock:
+            if not self._loaded:
+                self._load_index()
+                self._loaded = True
 
-        self._save_index()
+    def close(self):
+        """Finish background index work and release API connections before the process exits"""
+        self.embedder.close()
+        self.vectors.close()
+        self.http_client.close()
+
+    def _load_index(self):
+        self.vectors.load()
+        if os.path.exists(self.meta_path):
+            self._import_legacy_metadata()
 
-        # Save to database
+        # Vectors without a chunk row belong to deleted documents
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO documents (doc_id, user_email, filename, chunks_count) VALUES (?, ?, ?, ?)",
-                (doc_id, user_email, filename, len(chunks))
+            cursor.execute("SELECT vec_id FROM chunks")
+            live = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+        removed = np.ones(self.vectors.ntotal, dtype=bool)
+        removed[live[live < len(removed)]] = False
+        self.vectors.remove(np.flatnonzero(removed))
+
+    def _import_legacy_metadata(self):
+        """Move chunk metadata from the old pickle file into the chunks table"""
+        with open(self.meta_path, 'rb') as f:
+            data = pickle.load(f)
+        documents, metadatas = data['documents'], data['metadatas']
+
+        with get_db(write=True) as conn:
+            cursor = conn.cursor()
+            # Vector ids were positions in the old lists
+            cursor.executemany(
+                "INSERT OR IGNORE INTO chunks (vec_id, doc_id, user_email, filename, chunk_id, content) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (i, meta["doc_id"], meta["user_email"], meta["filename"], meta["chunk_id"], text)
+                    for i, (text, meta) in enumerate(zip(documents, metadatas))
+                ]
             )
             conn.commit()
 
-        return {
-            "document_id": doc_id,
-            "filename": filename,
-            "chunks_created": len(chunks)
-        }
+        os.remove(self.meta_path)
+
+    def _word_spans(self, text: str):
+        """Return (start, end) string offsets of every whitespace-separated word"""
+        # Locate word boundaries once with a vectorized scan over the code points (UTF-32
+        # keeps array offsets equal to string indices)
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        is_word = ~WHITESPACE_TABLE[np.minimum(codes, len(WHITESPACE_TABLE) - 1)]
+        edges = np.diff(is_word.view(np.int8), prepend=0, append=0)
+        return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    def chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+        # Slice each chunk straight out of the text rather than re-joining its words
+        starts, ends = self._word_spans(text)
+        # Offsets of every chunk's first and last word, computed in one pass
+        first = np.arange(0, len(starts), chunk_size - overlap)
+        last = np.minimum(first + chunk_size, len(starts)) - 1
+        return [text[start:end] for start, end in zip(starts[first].tolist(), ends[last].tolist())]
+
+    def iter_chunks(self, pages: Iterable[str], chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+        """Chunk page texts as they arrive; yields the same chunks as chunk_text("\n".join(pages))"""
+        step = chunk_size - overlap
+        buffer = ""
+        for page in pages:
+            buffer = f"{buffer}\n{page}" if buffer else page
+            starts, ends = self._word_spans(buffer)
+            # A chunk is final once all of its words have arrived
+            complete = np.arange(0, len(starts) - chunk_size + 1, step)
+            for start, end in zip(starts[complete].tolist(), ends[complete + chunk_size - 1].tolist()):
+                yield buffer[start:end]
+            if len(complete):
+                # Keep the text from the first chunk still waiting for words
+                following = complete[-1] + step
+                buffer = buffer[starts[following]:] if following < len(starts) else ""
+        if buffer:
+            yield from self.chunk_text(buffer, chunk_size, overlap)
+
+    def add_document(self, text: str, filename: str, user_email: str) -> Optional[Dict]:
+        return self.add_document_pages([text], filename, user_email)
+
+    def add_document_pages(self, pages: Iterable[str], filename: str, user_email: str) -> Optional[Dict]:
+        """Add a document from its page texts; returns None if it has no text to index.
+
+        Pages are chunked as they are read and every full batch of chunks is sent
+        for embedding straight away, so parsing overlaps the embedding requests.
+        """
+        chunks, embeddings = self._embed_chunks(self.iter_chunks(pages))
+        if not chunks:
+            return None
+        return self._store_documents([(filename, chunks)], embeddings, user_email)[0]
+
+    def add_documents(self, documents: List[Tuple[str, str]], user_email: str) -> List[Dict]:
+        """Add several (text, filename) documents with one embedding pass, transaction and index add.
+
+        Documents without any text are skipped and left out of the result.
+        """
+        chunked = [(filename, chunks) for text, filename in documents if (chunks := self.chunk_text(text))]
+        if not chunked:
+            return []
+        # Embedding batches span document boundaries, so small documents share requests
+        _, embeddings = self._embed_chunks(chunk for _, chunks in chunked for chunk in chunks)
+        return self._store_documents(chunked, embeddings, user_email)
+
+    def _embed_chunks(self, chunks: Iterable[str]) -> Tuple[List[str], np.ndarray]:
+        """Embed chunks in batches submitted as soon as each fills, preserving order"""
+        collected = []
+        pending = []
+        for chunk in chunks:
+            collected.append(chunk)
+            if len(collected) % EMBED_BATCH_SIZE == 0:
+                pending.append(self.embedder.submit_documents(collected[-EMBED_BATCH_SIZE:]))
+        if len(collected) % EMBED_BATCH_SIZE:
+            pending.append(self.embedder.submit_documents(collected[-(len(collected) % EMBED_BATCH_SIZE):]))
+        if not pending:
+            return collected, np.empty((0, self.dimension), dtype=np.float32)
+        return collected, np.vstack([future.result() for future in pending])
+
+    def _store_documents(self, documents: List[Tuple[str, List[str]]], embeddings: np.ndarray,
+                         user_email: str) -> List[Dict]:
+        """Index (filename, chunks) documents whose chunk embeddings are stacked in order"""
+        doc_ids = [str(uuid.uuid4()) for _ in documents]
+
+        with self._index_lock:
+            vec_id = self.vectors.ntotal
+            chunk_rows = []
+            for doc_id, (filename, chunks) in zip(doc_ids, documents):
+                chunk_rows.extend(
+                    (vec_id + i, doc_id, user_email, filename, i, chunk) for i, chunk in enumerate(chunks)
+                )
+                vec_id += len(chunks)
+
+            # Save to database; committed only once the vectors are persisted
+            with get_db(write=True) as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    "INSERT INTO documents (doc_id, user_email, filename, chunks_count) VALUES (?, ?, ?, ?)",
+                    [
+                        (doc_id, user_email, filename, len(chunks))
+                        for doc_id, (filename, chunks) in zip(doc_ids, documents)
+                    ]
+                )
+                cursor.executemany(
+                    "INSERT INTO chunks (vec_id, doc_id, user_email, filename, chunk_id, content) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    chunk_rows
+                )
+                self.vectors.add(embeddings)
+                self.vectors.save()
+                conn.commit()
+            self._invalidate_answers()
+
+        return [
+            {
+                "document_id": doc_id,
+                "filename": filename,
+                "chunks_created": len(chunks)
+            }
+            for doc_id, (filename, chunks) in zip(doc_ids, documents)
+        ]
 
     def get_user_documents(self, user_email: str) -> List[Dict]:
         """Get all documents for a user"""
@@ -109,183 +338,247 @@ class RAGService:
 
     def delete_document(self, doc_id: str, user_email: str) -> bool:
         """Delete a document and its embeddings"""
-        # Find indices to remove
-        indices_to_remove = []
-        for i, meta in enumerate(self.metadatas):
-            if meta["doc_id"] == doc_id and meta["user_email"] == user_email:
-                indices_to_remove.append(i)
-
-        if not indices_to_remove:
-            return False
-
-        # Remove from lists (reverse order to maintain indices)
-        for idx in sorted(indices_to_remove, reverse=True):
-            del self.documents[idx]
-            del self.metadatas[idx]
-
-        # Rebuild FAISS index
-        if len(self.documents) > 0:
-            # Re-embed all remaining documents
-            response = self.cohere_client.embed(
-                texts=self.documents,
-                model="embed-english-v3.0",
-                input_type="search_document"
-            )
-            embeddings = np.array(response.embeddings).astype('float32')
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.index.add(embeddings)
-        else:
-            self.index = faiss.IndexFlatL2(self.dimension)
-
-        self._save_index()
-
-        # Remove from database
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM documents WHERE doc_id = ? AND user_email = ?",
-                (doc_id, user_email)
-            )
-            conn.commit()
+        with self._index_lock:
+            with get_db(write=True) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT vec_id FROM chunks WHERE doc_id = ? AND user_email = ?",
+                    (doc_id, user_email)
+                )
+                vec_ids = [row["vec_id"] for row in cursor.fetchall()]
+                if not vec_ids:
+                    return False
+
+                cursor.execute("DELETE FROM chunks WHERE doc_id = ? AND user_email = ?", (doc_id, user_email))
+                cursor.execute(
+                    "DELETE FROM documents WHERE doc_id = ? AND user_email = ?",
+                    (doc_id, user_email)
+                )
+                conn.commit()
+
+            # The deleted chunk rows are the record of removal, so nothing else is persisted
+            self.vectors.remove(vec_ids)
+            self._invalidate_answers()
 
         return True
 
-    def query_with_conversation(self, question: str, conversation_id: str, user_email: str, top_k: int = 3) -> Dict:
-        """Query with conversation history"""
-        # Get conversation history
+    def _coalesce(self, key: Hashable, compute: Callable[[], Dict]) -> Dict:
+        """Run compute once for concurrent calls with the same key and share its result"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = compute()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _lookup_answer(self, question: str, scope: tuple):
+        """Return (cached result or None, query embedding or None if the exact cache hit)"""
+        cached = self.answer_cache.get(question, scope)
+        if cached is not None:
+            return cached, None
+        query_embedding = self.embedder.embed_with_cache(question)
+        return self.answer_cache.get_similar(query_embedding, scope), query_embedding
+
+    def _stream_answer(self, question: str, scope: tuple, top_k: int, build_messages) -> Iterator[Dict]:
+        """Yield a sources event, then answer token events, caching the full answer at the end"""
+        cached, query_embedding = self._lookup_answer(question, scope)
+        if cached is not None:
+            yield {"type": "sources", "sources": cached["sources"]}
+            yield {"type": "token", "content": cached["answer"]}
+            return
+
+        contexts, metadatas = self._search(query_embedding, top_k)
+        sources = self._format_sources(contexts, metadatas)
+        yield {"type": "sources", "sources": sources}
+
+        stream = self.groq_client.chat.completions.create(
+            messages=build_messages(contexts),
+            model=LLM_MODEL,
+            temperature=0.3,
+            max_tokens=MAX_ANSWER_TOKENS,
+            stream=True
+        )
+
+        parts = []
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield {"type": "token", "content": delta}
+
+        self.answer_cache.put(question, scope, query_embedding, {"answer": "".join(parts), "sources": sources})
+
+    @staticmethod
+    def _collect(events: Iterator[Dict]) -> Dict:
+        sources = []
+        parts = []
+        for event in events:
+            if event["type"] == "sources":
+                sources = event["sources"]
+            elif event["type"] == "token":
+                parts.append(event["content"])
+        return {"answer": "".join(parts), "sources": sources}
+
+    def _load_history(self, conversation_id: str) -> List[Dict]:
+        """Return the last HISTORY_LIMIT messages of a conversation, oldest first"""
+        with self._histories_lock:
+            cached = self._histories.get(conversation_id)
+            if cached is not None:
+                return list(cached)
+            misses = self._history_misses
+
+        # Earlier turns may still be queued for the background writer
+        flush_writes()
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY created_at ASC LIMIT 10",
-                (conversation_id,)
+                "SELECT role, content FROM messages WHERE conversation_id = ? "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (conversation_id, HISTORY_LIMIT)
             )
-            history = [{"role": row["role"], "content": row["content"]} for row in cursor.fetchall()]
+            history = [{"role": row["role"], "content": row["content"]} for row in cursor.fetchall()][::-1]
+
+        with self._histories_lock:
+            # A turn saved meanwhile may be missing from the rows read, so leave those uncached;
+            # a concurrent load may also have cached the history already
+            if self._history_misses == misses:
+                self._histories.setdefault(conversation_id, deque(history, maxlen=HISTORY_LIMIT))
+        return history
+
+    def _forget_history(self, conversation_id: str):
+        with self._histories_lock:
+            self._histories.pop(conversation_id, None)
+
+    def _save_turn(self, conversation_id: str, user_email: str, question: str, answer: str,
+                   new_conversation: bool):
+        """Queue a turn's messages for the background writer and add them to the cached history"""
+        job = []
+        if new_conversation:
+            job.append(("INSERT INTO conversations (id, user_email) VALUES (?, ?)", [(conversation_id, user_email)]))
+        job.append((
+            "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+            [(conversation_id, "user", question), (conversation_id, "assistant", answer)]
+        ))
+        messages = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+        # Cache and queue together: the rows only become visible after this, so a reload
+        # either reads them or sees the miss counter move
+        with self._histories_lock:
+            cached = self._histories.get(conversation_id)
+            if cached is not None:
+                cached.extend(messages)
+            elif new_conversation:
+                self._histories[conversation_id] = deque(messages, maxlen=HISTORY_LIMIT)
+            else:
+                # Evicted mid-turn; the next turn reloads it from the database
+                self._history_misses += 1
+            # If the write fails the cached turn is gone from the database, so drop the entry
+            submit_write(job, on_error=lambda: self._forget_history(conversation_id))
+
+    def query_with_conversation_stream(self, question: str, conversation_id: str, user_email: str,
+                                       top_k: int = 3, new_conversation: bool = False) -> Iterator[Dict]:
+        """Stream an answer with conversation history; the turn is saved once the answer is complete.
+
+        With new_conversation the conversation row is created together with its first messages.
+        """
+        # Get conversation history
+        history = [] if new_conversation else self._load_history(conversation_id)
 
-        # Get relevant documents
-        response = self.cohere_client.embed(
-            texts=[question],
-            model="embed-english-v3.0",
-            input_type="search_query"
-        )
-        query_embedding = np.array(response.embeddings).astype('float32')
+        def build_messages(contexts: List[str]) -> List[Dict]:
+            recent, contexts = _fit_prompt([CHAT_SYSTEM_PROMPT, CHAT_PROMPT_PREFIX, question], history[-5:], contexts)
 
-        distances, indices = self.index.search(query_embedding, top_k)
+            # Build prompt with history
+            context_text = "\n\n".join([f"Context {i + 1}: {ctx}" for i, ctx in enumerate(contexts)])
 
-        contexts = []
-        metadatas = []
-        for idx in indices[0]:
-            if idx < len(self.documents):
-                contexts.append(self.documents[idx])
-                metadatas.append(self.metadatas[idx])
-
-        # Build prompt with history
-        context_text = "\n\n".join([f"Context {i + 1}: {ctx}" for i, ctx in enumerate(contexts)])
-
-        # Build conversation messages
-        messages = [
-            {"role": "system",
-             "content": "You are a helpful assistant that answers questions based on the provided context and conversation history. Be concise and accurate."}
-        ]
+            # Build conversation messages
+            messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
 
-        # Add history (last 5 messages)
-        messages.extend(history[-5:])
+            # Add history (last 5 messages, fewer if over the token budget)
+            messages.extend(recent)
 
-        # Add current query with context
-        user_message = f"""Based on the following context, answer the question:
+            # Add current query with context
+            user_message = f"{CHAT_PROMPT_PREFIX}{context_text}\n\nQuestion: {question}"
 
-Context:
-{context_text}
+            messages.append({"role": "user", "content": user_message})
+            return messages
 
-Question: {question}"""
+        # The answer depends on the history sent with the question, not just the conversation
+        history_digest = hashlib.sha256(json.dumps(history[-5:]).encode('utf-8')).digest()
+        scope = (top_k, self._corpus_version, conversation_id, history_digest)
+        parts = []
+        for event in self._stream_answer(question, scope, top_k, build_messages):
+            if event["type"] == "sources":
+                event["conversation_id"] = conversation_id
+            elif event["type"] == "token":
+                parts.append(event["content"])
+            yield event
 
-        messages.append({"role": "user", "content": user_message})
+        # Save messages to database in one transaction, committed in the background
+        self._save_turn(conversation_id, user_email, question, "".join(parts), new_conversation)
 
-        # Get answer
-        chat_completion = self.groq_client.chat.completions.create(
-            messages=messages,
-            model="llama-3.1-8b-instant",
-            temperature=0.3,
-            max_tokens=500
-        )
+    def query_with_conversation(self, question: str, conversation_id: str, user_email: str, top_k: int = 3,
+                                new_conversation: bool = False) -> Dict:
+        """Query with conversation history"""
+        # A duplicate turn (e.g. the same question sent from two tabs) is answered and saved once
+        key = (conversation_id, user_email, question.strip().lower(), top_k)
+        return self._coalesce(key, lambda: self._collect(self.query_with_conversation_stream(
+            question, conversation_id, user_email, top_k, new_conversation
+        )))
 
-        answer = chat_completion.choices[0].message.content
+    def query_stream(self, question: str, top_k: int = 3) -> Iterator[Dict]:
+        """Stream an answer without conversation history"""
 
-        # Save messages to database
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                (conversation_id, "user", question)
-            )
-            cursor.execute(
-                "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                (conversation_id, "assistant", answer)
-            )
-            conn.commit()
+        def build_messages(contexts: List[str]) -> List[Dict]:
+            _, contexts = _fit_prompt([QUERY_SYSTEM_PROMPT, QUERY_PROMPT_PREFIX, question], [], contexts)
+            context_text = "\n\n".join([f"Context {i + 1}: {ctx}" for i, ctx in enumerate(contexts)])
+            prompt = f"{QUERY_PROMPT_PREFIX}{context_text}\n\nQuestion: {question}\n\nAnswer:"
 
-        sources = [
-            {
-                "filename": meta["filename"],
-                "chunk_id": meta["chunk_id"],
-                "text": ctx[:200] + "..."
-            }
-            for meta, ctx in zip(metadatas, contexts)
-        ]
+            return [
+                {"role": "system", "content": QUERY_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
 
-        return {"answer": answer, "sources": sources}
+        scope = (top_k, self._corpus_version, None)
+        yield from self._stream_answer(question, scope, top_k, build_messages)
 
     def query(self, question: str, top_k: int = 3) -> Dict:
         """Simple query without conversation history"""
-        response = self.cohere_client.embed(
-            texts=[question],
-            model="embed-english-v3.0",
-            input_type="search_query"
-        )
-        query_embedding = np.array(response.embeddings).astype('float32')
-
-        distances, indices = self.index.search(query_embedding, top_k)
-
-        contexts = []
-        metadatas = []
-        for idx in indices[0]:
-            if idx < len(self.documents):
-                contexts.append(self.documents[idx])
-                metadatas.append(self.metadatas[idx])
-
-        context_text = "\n\n".join([f"Context {i + 1}: {ctx}" for i, ctx in enumerate(contexts)])
-        prompt = f"""Based on the following context, answer the question. If you cannot answer based on the context, say so.
-
-Context:
-{context_text}
-
-Question: {question}
-
-Answer:"""
+        key = (None, None, question.strip().lower(), top_k)
+        return self._coalesce(key, lambda: self._collect(self.query_stream(question, top_k)))
 
-        chat_completion = self.groq_client.chat.completions.create(
-            messages=[
-                {"role": "system",
-                 "content": "You are a helpful assistant that answers questions based on the provided context. Be concise and accurate."},
-                {"role": "user", "content": prompt}
-            ],
-            model="llama-3.1-8b-instant",
-
-            temperature=0.3,
-            max_tokens=500
-        )
 
-        answer = chat_completion.choices[0].message.content
+_rag_service: Optional[RAGService] = None
+_rag_service_lock = threading.Lock()
 
-        sources = [
-            {
-                "filename": meta["filename"],
-                "chunk_id": meta["chunk_id"],
-                "text": ctx[:200] + "..."
-            }
-            for meta, ctx in zip(metadatas, contexts)
-        ]
 
-        return {"answer": answer, "sources": sources}
+def get_rag_service() -> RAGService:
+    """Return the process-wide RAGService, creating and loading it on first use"""
+    global _rag_service
+    if _rag_service is None:
+        with _rag_service_lock:
+            if _rag_service is None:
+                service = RAGService()
+                service.warmup()
+                _rag_service = service
+    return _rag_service
 
 
-rag_service = RAGService()
\ No newline at end of file
+def close_rag_service():
+    """Close the process-wide RAGService; a later get_rag_service() creates a fresh one"""
+    global _rag_service
+    with _rag_service_lock:
+        service, _rag_service = _rag_service, None
+    if service is not None:
+        service.close()
@@ -0,0 +1,371 @@
+import glob
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from app.core.config import settings as app_settings
+
+logger = logging.getLogger(__name__)
+
+# Map the saved base index read-only instead of copying it into RAM. IO_FLAG_MMAP
+# covers IVF inverted lists; newer faiss releases add IO_FLAG_MMAP_IFC for flat/HNSW codes.
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+# OpenMP fan-out costs more than it saves on the small query batches searched here
+faiss.omp_set_num_threads(app_settings.FAISS_OMP_THREADS)
+
+# Upper bound on queries answered by one batched index search
+MAX_SEARCH_BATCH = 64
+
+# Index types that must be trained on real vectors, with the setting giving how many to wait for
+TRAINED_INDEX_TYPES = {"hnsw_sq8": "FAISS_SQ_TRAIN_SIZE", "ivfpq": "FAISS_IVF_TRAIN_SIZE"}
+
+
+class VectorStore:
+    """FAISS index split into a memory-mapped base and an in-memory delta.
+
+    The base is loaded read-only from disk, so the OS pages vectors in on demand.
+    New vectors go to a small flat delta
+    index and are persisted as append-only segment files named after the id of
+    their first vector; once the delta reaches FAISS_DELTA_MERGE_SIZE a
+    background thread folds it into the base, rewrites the base file, maps it
+    again and removes the merged segments. Vector ids are positions in
+    base-then-delta order, which merging preserves.
+
+    Removed vectors stay in the index as tombstones and are filtered out of
+    searches with an ID selector, so ids are never renumbered.
+
+    Concurrent searches are gathered by a worker thread for up to
+    FAISS_SEARCH_BATCH_WINDOW_MS and answered with one batched index search.
+
+    Ids and segment names come from this process's view of the index, so only
+    one process may use the files at a time: load() takes an exclusive lock
+    and fails if another process (e.g. a second uvicorn worker) holds it.
+    """
+
+    def __init__(self, dimension: int, index_path: str):
+        self.dimension = dimension
+        self._check_settings()
+        self.index_path = index_path
+        root, ext = os.path.splitext(index_path)
+        self._segment_prefix = f"{root}.delta."
+        self._segment_suffix = ext
+
+        self.base = self._new_index()
+        self.delta = faiss.IndexFlatIP(dimension)
+        # Whether self.base is the read-only mapping of index_path (and so must not be modified)
+        self._base_mapped = False
+        self._merging = False
+        self._merge_thread = None
+        # removed[i] is set once vector id i is removed (sized to the largest removed id), and
+        # the search parameters excluding those ids, built on demand
+        self._removed = np.zeros(0, dtype=bool)
+        self._search_params = None
+        self._lock = threading.Lock()
+
+        self._search_requests = queue.Queue()
+        self._search_worker = None
+        self._lock_file = None
+
+    def _check_settings(self):
+        """Reject index settings that would otherwise only fail later, inside a background merge"""
+        index_type = app_settings.FAISS_INDEX_TYPE
+        if index_type not in ("hnsw", *TRAINED_INDEX_TYPES):
+            raise ValueError(f"Unknown FAISS_INDEX_TYPE {index_type!r}")
+        if index_type == "ivfpq":
+            if self.dimension % app_settings.FAISS_PQ_M:
+                raise ValueError(f"FAISS_PQ_M must divide the embedding dimension {self.dimension}")
+            if app_settings.FAISS_IVF_TRAIN_SIZE < app_settings.FAISS_IVF_NLIST:
+                raise ValueError("FAISS_IVF_TRAIN_SIZE must be at least FAISS_IVF_NLIST")
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.delta.ntotal
+
+    def _new_index(self):
+        """Create an empty index using cosine similarity (inner product on normalized vectors)"""
+        if app_settings.FAISS_INDEX_TYPE in TRAINED_INDEX_TYPES:
+            # Quantizers need training data, so stage vectors in a flat index until enough arrive
+            return faiss.IndexFlatIP(self.dimension)
+
+        index = faiss.IndexHNSWFlat(self.dimension, app_settings.FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = app_settings.FAISS_HNSW_EF_CONSTRUCTION
+        self._configure_index(index)
+        return index
+
+    def _ready_to_train(self, base, count: int) -> bool:
+        """Whether a staging base plus count new vectors is enough to train the configured index"""
+        setting = TRAINED_INDEX_TYPES.get(app_settings.FAISS_INDEX_TYPE)
+        return (setting is not None
+                and isinstance(base, faiss.IndexFlat)
+                and base.ntotal + count >= getattr(app_settings, setting))
+
+    def _train_index(self, vectors: np.ndarray):
+        """Train the configured quantized index on the given vectors and add them to it"""
+        if app_settings.FAISS_INDEX_TYPE == "hnsw_sq8":
+            # 8-bit codes per dimension: a quarter of the float32 memory and bandwidth
+            index = faiss.IndexHNSWSQ(
+                self.dimension, faiss.ScalarQuantizer.QT_8bit, app_settings.FAISS_HNSW_M,
+                faiss.METRIC_INNER_PRODUCT
+            )
+            index.hnsw.efConstruction = app_settings.FAISS_HNSW_EF_CONSTRUCTION
+        else:
+            quantizer = faiss.IndexFlatIP(self.dimension)
+            index = faiss.IndexIVFPQFastScan(
+                quantizer, self.dimension, app_settings.FAISS_IVF_NLIST,
+                app_settings.FAISS_PQ_M, 4, faiss.METRIC_INNER_PRODUCT
+            )
+        index.train(vectors)
+        index.add(vectors)
+        self._configure_index(index)
+        return index
+
+    def _configure_index(self, index):
+        """Apply search-time parameters, which are not restored by faiss.read_index"""
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = app_settings.FAISS_HNSW_EF_SEARCH
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = app_settings.FAISS_IVF_NPROBE
+
+    def _read_mapped(self):
+        index = faiss.read_index(self.index_path, MMAP_FLAGS)
+        self._configure_index(index)
+        return index
+
+    def _write_atomic(self, index, path: str):
+        tmp_path = path + ".tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        """Return (first vector id, path) of the delta segments on disk, in id order"""
+        segments = []
+        for path in glob.glob(f"{self._segment_prefix}*{self._segment_suffix}"):
+            start = path[len(self._segment_prefix):len(path) - len(self._segment_suffix)]
+            if start.isdigit():
+                segments.append((int(start), path))
+        return sorted(segments)
+
+    def _needs_migration(self, index) -> bool:
+        """Whether a saved flat index predates the cosine/HNSW layout (e.g. an IndexFlatL2)"""
+        if not isinstance(index, faiss.IndexFlat):
+            return False
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            return True
+        # A flat inner-product base is only expected while a quantizer is still collecting training data
+        return app_settings.FAISS_INDEX_TYPE not in TRAINED_INDEX_TYPES and index.ntotal > 0
+
+    def _acquire_file_lock(self):
+        if fcntl is None or self._lock_file is not None:
+            return
+        lock_file = open(self.index_path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.index_path} is in use by another process; run the app with a single worker"
+            )
+        # Released when the file is closed, including when the process dies
+        self._lock_file = lock_file
+
+    def load(self):
+        with self._lock:
+            self._acquire_file_lock()
+            # Left behind by a process that stopped mid-write; the files they were replacing are intact
+            leftovers = glob.glob(f"{self._segment_prefix}*{self._segment_suffix}.tmp")
+            for leftover in [self.index_path + ".tmp", self.index_path + ".merge", *leftovers]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            if os.path.exists(self.index_path):
+                self.base = self._read_mapped()
+                if self._needs_migration(self.base):
+                    # Flat codes are the raw vectors, so they can be normalized and re-added exactly
+                    vectors = self.base.reconstruct_n(0, self.base.ntotal)
+                    faiss.normalize_L2(vectors)
+                    index = self._new_index()
+                    index.add(vectors)
+                    self._write_atomic(index, self.index_path)
+                    self.base = self._read_mapped()
+                self._base_mapped = True
+            for start, path in self._segments():
+                if start < self.ntotal:
+                    # Already folded into the base by a merge that stopped before cleaning up
+                    os.remove(path)
+                    continue
+                segment = faiss.read_index(path)
+                self.delta.add(segment.reconstruct_n(0, segment.ntotal))
+
+    def close(self):
+        """Wait for a running merge, so shutdown does not abandon a half-written base"""
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def save(self):
+        """Write the base if it is not on disk yet; added vectors are already persisted as segments"""
+        with self._lock:
+            if not self._base_mapped:
+                self._write_atomic(self.base, self.index_path)
+                self.base = self._read_mapped()
+                self._base_mapped = True
+
+    def add(self, embeddings: np.ndarray):
+        segment = faiss.IndexFlatIP(self.dimension)
+        segment.add(embeddings)
+        with self._lock:
+            # Only the new vectors are written, so the cost is independent of corpus size
+            self._write_atomic(segment, f"{self._segment_prefix}{self.ntotal:012d}{self._segment_suffix}")
+            self.delta.add(embeddings)
+            if self._merging:
+                return
+            # A staging base is also merged as soon as there are enough vectors to train on
+            if (self.delta.ntotal < app_settings.FAISS_DELTA_MERGE_SIZE
+                    and not self._ready_to_train(self.base, self.delta.ntotal)):
+                return
+            self._merging = True
+            self._merge_thread = threading.Thread(target=self._merge, name="faiss-merge", daemon=True)
+            self._merge_thread.start()
+
+    def remove(self, ids):
+        """Exclude the given vector ids from future searches"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        with self._lock:
+            if ids.max() >= len(self._removed):
+                grown = np.zeros(ids.max() + 1, dtype=bool)
+                grown[:len(self._removed)] = self._removed
+                self._removed = grown
+            self._removed[ids] = True
+            self._search_params = None
+
+    def _params(self, index, removed: np.ndarray):
+        """Search parameters for index that skip ids flagged in removed (kept alive with their selector)"""
+        # Ids past the end of the bitmap are not members, so vectors added later stay searchable
+        bitmap = np.packbits(removed, bitorder='little')
+        inner = faiss.IDSelectorBitmap(bitmap)
+        selector = faiss.IDSelectorNot(inner)
+        # Explicit parameters replace the index's own efSearch/nprobe, so carry them over
+        if isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+        elif isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return params, (bitmap, inner, selector)
+
+    def _current_params(self):
+        """Return (base params, delta params), or (None, None) with nothing removed; call under the lock"""
+        if self._search_params is None:
+            if not self._removed.any():
+                return None, None
+            offset = self.base.ntotal
+            self._search_params = (
+                self._params(self.base, self._removed[:offset]),
+                self._params(self.delta, self._removed[offset:]),
+            )
+        (base_params, _), (delta_params, _) = self._search_params
+        return base_params, delta_params
+
+    def search(self, query_embedding: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (scores, ids) of the top_k most similar vectors, best first"""
+        future = Future()
+        self._search_requests.put((query_embedding, top_k, future))
+        if self._search_worker is None:
+            with self._lock:
+                if self._search_worker is None:
+                    self._search_worker = threading.Thread(
+                        target=self._serve_searches, name="faiss-search", daemon=True
+                    )
+                    self._search_worker.start()
+        return future.result()
+
+    def _serve_searches(self):
+        window = app_settings.FAISS_SEARCH_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [self._search_requests.get()]
+            deadline = time.monotonic() + window
+            while len(batch) < MAX_SEARCH_BATCH:
+                try:
+                    batch.append(self._search_requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                queries = np.vstack([query for query, _, _ in batch])
+                scores, ids = self._search_batch(queries, max(top_k for _, top_k, _ in batch))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for row, (_, top_k, future) in enumerate(batch):
+                found = ids[row] >= 0
+                future.set_result((scores[row][found][:top_k], ids[row][found][:top_k]))
+
+    def _search_batch(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            base_params, delta_params = self._current_params()
+            base_scores, base_ids = self.base.search(queries, top_k, params=base_params)
+            delta_scores, delta_ids = self.delta.search(queries, top_k, params=delta_params)
+            offset = self.base.ntotal
+
+        scores = np.concatenate([base_scores, delta_scores], axis=1)
+        ids = np.concatenate([base_ids, np.where(delta_ids >= 0, delta_ids + offset, -1)], axis=1)
+        # FAISS pads with -1 when fewer than top_k vectors are indexed; rank those last
+        scores[ids < 0] = -np.inf
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def _merge(self):
+        try:
+            with self._lock:
+                count = self.delta.ntotal
+                vectors = self.delta.reconstruct_n(0, count)
+                base, base_mapped = self.base, self._base_mapped
+
+            # Build the merged base off the lock; searches keep using the current one
+            if self._ready_to_train(base, count):
+                merged = self._train_index(np.vstack([base.reconstruct_n(0, base.ntotal), vectors]))
+            else:
+                # A mapped index cannot grow, so start from an owned copy read back from disk
+                merged = faiss.read_index(self.index_path) if base_mapped else faiss.clone_index(base)
+                merged.add(vectors)
+            tmp_path = self.index_path + ".merge"
+            faiss.write_index(merged, tmp_path)
+            del merged
+
+            with self._lock:
+                os.replace(tmp_path, self.index_path)
+                # Keep vectors that arrived while merging
+                delta = faiss.IndexFlatIP(self.dimension)
+                delta.add(self.delta.reconstruct_n(count, self.delta.ntotal - count))
+                self.base = self._read_mapped()
+                self._base_mapped = True
+                self.delta = delta
+                # The base/delta split of the removed ids moved
+                self._search_params = None
+                for start, path in self._segments():
+                    if start < self.base.ntotal:
+                        os.remove(path)
+        except Exception:
+            # The delta and its segments are untouched, so the next add simply retries
+            logger.exception("Merging the FAISS delta into the base index failed")
+        finally:
+            with self._lock:
+                self._merging = False
@@ -0,0 +1,50 @@
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Not the Llama tokenizer, but close enough to budget prompts by
+TOKEN_ENCODING = "cl100k_base"
+# Rough characters per token, used if the encoding cannot be loaded (it is downloaded on first use)
+CHARS_PER_TOKEN = 4
+
+_encoding: Optional[tiktoken.Encoding] = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception:
+                    logger.warning("Could not load the %s encoding; estimating token counts", TOKEN_ENCODING)
+                    _encoding_failed = True
+    return _encoding
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Approximate number of tokens in text (cached, as the same chunks are retrieved repeatedly)"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Keep the first max_tokens tokens of text"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])